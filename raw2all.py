@@ -1,11 +1,14 @@
 import re
+import sys
+import functools
 import traceback
-from copy import deepcopy
 from collections import defaultdict
 
 import bibtexparser
+import citerra
 from bibtexparser.model import Entry, Field
 from bibtexparser.library import Library
+from bibtexparser.middlewares import default_unparse_stack
 from bibtexparser.writer import BibtexFormat
 
 
@@ -74,127 +77,172 @@ mapping = {
     'WWW': 'World Wide Web',
 }
 
+# BetterBibTex does not handle name prefix
+_PREFIX_RE = re.compile(r'family=([\w. ]+), given=([\w. ]+), prefix=([\w. ]+), useprefix=(true|false)')
+_STRIP_BRACES = str.maketrans('', '', '{}')
+# fields copied verbatim from the raw entry, by output entry type
+_KEEP_SETS = {
+    'article': frozenset({'year', 'title', 'volume', 'issue', 'publisher', 'pages'}),
+    'inproceedings': frozenset({'year', 'title'}),
+    'incollection': frozenset({'year', 'title', 'booktitle', 'pages', 'publisher'}),
+    'thesis': frozenset({'year', 'title', 'institution', 'type'}),
+    'misc': frozenset({'year', 'title'}),
+}
+
 
+@functools.lru_cache(maxsize=None)
 def abbr2full(abbr: str):
-    abbr = abbr.replace('{', '').replace('}', '')
+    # the same venues recur across the library, so cache the expansion
+    abbr = abbr.translate(_STRIP_BRACES)
     parts = abbr.split('-')
-    is_abbr = [part in mapping for part in parts]
-    if all(is_abbr):
-        ret = ''
-        for part in parts:
-            ret += ' and ' + mapping[part]
-        ret = ret[5:] + f' ({abbr})'
-        return ret.replace('  ', ' ').strip()
-    elif not is_abbr[0]:
-        return abbr.replace('  ', ' ').strip()
+    full = list()
+    for part in parts:
+        name = mapping.get(part)
+        if name is None:
+            break
+        full.append(name)
+    if len(full) == len(parts):
+        ret = ' and '.join(full) + f' ({abbr})'
+        return ' '.join(ret.split())
+    elif not full:
+        return ' '.join(abbr.split())
     else:
         raise Exception(f'Unrecognized abbreviation: {abbr}')
 
 
 def fix_name(authors):
-    # BetterBibTex does not handle name prefix
-    prefix_pattern = r'family=([\w. ]+), given=([\w. ]+), prefix=([\w. ]+), useprefix=(true|false)'
-    for match in re.finditer(prefix_pattern, authors):
-        name = match.string[match.start():match.end()]
-        pieces = match.groups()
-        new_name = f'{pieces[2]} {pieces[0]}, {pieces[1]}'
-        assert name in authors
-        authors = authors.replace(name, new_name)
-    return authors
-
-
-def process_entry(entry1) -> Entry | None:
-    entry1 = deepcopy(entry1)
-    fields = entry1.fields_dict
+    # rewrite `family=Berg, given=Jan, prefix=van den, ...` as `van den Berg, Jan`
+    return _PREFIX_RE.sub(lambda match: f'{match.group(3)} {match.group(1)}, {match.group(2)}', authors)
+
+
+def is_arxiv_id(eprint: str) -> bool:
+    # old style `archive/1234567` or new style `1234.5678`, optionally followed by `v2`
+    head, sep, version = eprint.rpartition('v')
+    if sep and version.isdecimal():
+        eprint = head
+    if '/' in eprint:
+        archive, _, number = eprint.partition('/')
+        return archive != '' and all(c.isalnum() or c == '_' for c in archive) and number.isdecimal()
+    if '.' in eprint:
+        year_month, _, number = eprint.partition('.')
+        return year_month.isdecimal() and number.isdecimal()
+    return False
+
+
+def process_entry(fields: dict) -> Entry | None:
+    # `fields` maps field names to plain values, plus `ENTRYTYPE` and `ID`
     # remove illegal items
     if 'author' not in fields or fields['author'] == '':
         return None
-    if 'keywords' in fields and 'nobib' in fields['keywords'].value:
+    if 'keywords' in fields and 'nobib' in fields['keywords']:
         return None
 
     new = dict()
     if 'date' in fields and 'year' not in fields:
-        new['year'] = fields['date'].value[:4]
+        new['year'] = sys.intern(fields['date'][:4])
     else:
-        new['year'] = fields['year']
+        new['year'] = sys.intern(fields['year'])
     if 'url' in fields:
-        # prefer using https
-        new['url'] = fields['url'].value.replace('http://', 'https://')
-        if not new['url'].startswith('http'):
-            new.pop('url', None)
+        # prefer using https, and drop non-web links
+        url = fields['url']
+        if url.startswith('http://'):
+            new['url'] = 'https://' + url[7:]
+        elif url.startswith('https://'):
+            new['url'] = url
     else:
         if 'doi' in fields:
-            new['url'] = 'https://doi.org/' + fields['doi'].value
+            new['url'] = 'https://doi.org/' + fields['doi']
         elif fields.get('eprinttype', '') == 'arxiv' and 'eprint' in fields:
-            arxiv_patterns = [r'^\w+/\d+(v\d+)?$', r'^\d+\.\d+(v\d+)?$']
-            if any([re.findall(pat, fields['eprint'].value) for pat in arxiv_patterns]):
-                new['url'] = 'https://arxiv.org/abs/' + fields['eprint'].value
-    new['author'] = fix_name(fields['author'].value)
+            if is_arxiv_id(fields['eprint']):
+                new['url'] = 'https://arxiv.org/abs/' + fields['eprint']
+    new['author'] = fix_name(fields['author'])
 
-    et = entry1.entry_type
+    et = fields['ENTRYTYPE']
     # clean up fields
-    if entry1.entry_type == 'article':
-        to_keep = ['volume', 'issue', 'publisher', 'pages']
-        new['journal'] = abbr2full(fields['journaltitle'].value)
-        if 'number' in fields:
-            new['issue'] = fields['number'].value
-    elif entry1.entry_type == 'inproceedings':
-        to_keep = []
-        new['booktitle'] = 'Proceedings of ' + abbr2full(fields['booktitle'].value).strip()
-    elif entry1.entry_type == 'incollection':
-        to_keep = ['booktitle', 'pages', 'publisher']
-    elif entry1.entry_type == 'thesis':
-        to_keep = ['institution', 'type']
-    else:
+    if et == 'article':
+        new['journal'] = abbr2full(fields['journaltitle'])
+        # an explicit issue takes precedence over number
+        if 'issue' in fields:
+            new['issue'] = fields['issue']
+        elif 'number' in fields:
+            new['issue'] = fields['number']
+    elif et == 'inproceedings':
+        new['booktitle'] = sys.intern('Proceedings of ' + abbr2full(fields['booktitle']))
+    elif et not in _KEEP_SETS:
         et = 'misc'
-        to_keep = []
 
-    common_keeps = ['year', 'url', 'title']
-    for k in list(fields):
-        if k in common_keeps + to_keep:
-            new[k] = fields[k].value
-    return Entry(et, entry1.key, [Field(key, value) for key, value in new.items()])
+    keep = _KEEP_SETS[et]
+    for k, v in fields.items():
+        if k in keep and k not in new:
+            # short values (publishers, volumes, ...) repeat across the library
+            new[k] = sys.intern(v) if len(v) < 64 else v
+    return Entry(et, fields['ID'], [Field(key, value) for key, value in new.items()])
+
+
+def safe_process(entry):
+    try:
+        return entry['ID'], process_entry(entry), None
+    except Exception:
+        return entry['ID'], None, traceback.format_exc()
 
 
 def inspect(bib_db):
-    entries = defaultdict(list)
-    for entry in bib_db.entries:
-        entries[entry['ENTRYTYPE']].append(entry)
-    for entry_type, items in entries.items():
+    # entry type -> [count, fields seen, first few IDs]
+    stats = defaultdict(lambda: [0, set(), list()])
+    for entry in bib_db.to_dicts('expanded'):
+        stat = stats[entry['ENTRYTYPE']]
+        stat[0] += 1
+        stat[1].update(entry.keys())
+        if stat[0] < 10:
+            stat[2].append(entry['ID'])
+    for entry_type, (count, fields, ids) in stats.items():
         print('-' * 20)
-        print(entry_type, len(items))
-        fields = set()
-        for entry in items:
-            fields.update(set(entry.keys()))
+        print(entry_type, count)
         print('fields:', ', '.join(fields))
-        if len(items) < 10:
-            print('They are: ', ', '.join([item['ID'] for item in items]))
+        if count < 10:
+            print('They are: ', ', '.join(ids))
 
 
 def raw2all():
     raw_path = './raw.bib'
-    bib_db = bibtexparser.parse_file(raw_path)
+    # citerra is a native parser, much faster than bibtexparser on large files
+    # expand_values resolves @string macros, as bibtexparser did
+    bib_db = citerra.parse_file(raw_path, tolerant=True, expand_values=True)
+    if bib_db.status != 'ok':
+        # citerra recovers what it can from malformed blocks, which may leave entries incomplete
+        for diagnostic in bib_db.diagnostics:
+            print(f'Parsing problem at line {diagnostic.source.line}: {diagnostic.message}')
+            print(diagnostic.snippet)
     # inspect(bib_db)
 
     new_entries = list()
     errored = list()
-    for entry in list(bib_db.entries):
-        try:
-            processed = process_entry(entry)
-        except Exception as e:
-            print(traceback.format_exc())
-            errored.append(entry.key)
-            processed = None
-        if processed:
+    seen = set()
+    duplicated = list()
+    for entry in bib_db.to_dicts('expanded'):
+        # keep the first entry of a repeated key, as bibtexparser did
+        if entry['ID'] in seen:
+            duplicated.append(entry['ID'])
+            continue
+        seen.add(entry['ID'])
+        key, processed, error = safe_process(entry)
+        if error is not None:
+            print(error)
+            errored.append(key)
+        elif processed is not None:
             new_entries.append(processed)
 
     if errored:
         print('Error when processing', ' '.join(errored))
+    if duplicated:
+        print('Duplicate keys skipped', ' '.join(duplicated))
 
     new_db = Library(new_entries)
     bib_format = BibtexFormat()
     bib_format.indent = '  '
-    bibtexparser.write_file('./ref.bib', new_db, bibtex_format=bib_format)
+    # new_db is thrown away after writing, so let the writer modify it in place instead of copying every entry
+    unparse_stack = default_unparse_stack(allow_inplace_modification=True)
+    bibtexparser.write_file('./ref.bib', new_db, unparse_stack=unparse_stack, bibtex_format=bib_format)
 
 
 if __name__ == '__main__':